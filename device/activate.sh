@@ -2,4 +2,6 @@
 
 sleep 30
 source /home/sensor/.venv/bin/activate 2>/home/sensor/source.log
-python /home/sensor/test.py 2>/home/sensor/sensor_app.log
+cd /home/sensor
+# Én worker/tråd: hardwaren initialiseres én gang, og I2C-bussen er seriel
+gunicorn -b 0.0.0.0:5001 -w 1 -k gthread --threads 1 --keep-alive 30 test:app 2>/home/sensor/sensor_app.log
@@ -1,4 +1,7 @@
+import atexit
+import threading
 import time
+from bisect import bisect_left
 
 import smbus2
 from gpiozero import OutputDevice
@@ -6,18 +9,23 @@ from gpiozero import OutputDevice
 from luma.core.interface.serial import i2c
 from luma.core.render import canvas
 from luma.oled.device import ssd1306
+from PIL import Image, ImageDraw
 
 from ina219 import INA219
 from rpi_ws281x import PixelStrip, Color
 
 from apiflask import APIFlask, Schema
-from apiflask.fields import List, Float, Integer, String
+from apiflask.fields import List, Float, Integer, String, Nested
+from apiflask.validators import Range
 
-import Adafruit_ADS1x15
 # --------------------------
 # CONFIG
 # --------------------------
 I2C_PORT = 1
+# Alle enheder på bussen kan køre fast-mode; kræver i /boot/firmware/config.txt:
+#   dtparam=i2c_arm=on,i2c_arm_baudrate=400000
+I2C_BAUDRATE = 400_000
+I2C_CLOCK_PATH = f"/sys/bus/i2c/devices/i2c-{I2C_PORT}/of_node/clock-frequency"
 I2C_ADDR_OLED = 0x3C
 I2C_ADDR_INA219 = 0x40
 I2C_ADDR_ADS1115 = 0x48
@@ -25,7 +33,9 @@ I2C_ADDR_ADS1115 = 0x48
 MOSFET_PIN = 24
 
 V_IN_FALLBACK = 3.3
-ADS_GAIN = 1  # +/-4.096V
+
+# Antal målinger pr. /start-test (?n=K) – serveren gemmer dem samlet
+MAX_SAMPLES_PER_TEST = 100
 
 # Shunt-Modstand pr. kanal (Rs) dummy modstande der skal måles: a0 = 10K a1 = 22K a2 = 4.7K a3 = 27K
 RS_VALUES = [9950.0, 9890.0, 9970.0, 9930.0]
@@ -35,6 +45,15 @@ GOOD_MAX = 5000.0
 OK_MAX = 20000.0
 BAD_MAX = 500000.0
 
+# (status, farve) pr. interval – index findes med bisect på tærsklerne
+STATUS_THRESHOLDS = (GOOD_MAX, OK_MAX, BAD_MAX)
+STATUS_LEVELS = (
+    ("GOOD", Color(0, 255, 0)),
+    ("OK", Color(255, 255, 0)),
+    ("BAD", Color(255, 0, 0)),
+    ("FAIL", Color(0, 0, 255)),
+)
+
 # Failsafe max værdi (JSON-safe)
 OPEN_CIRCUIT_OHMS = 9_999_999.0
 
@@ -45,24 +64,181 @@ LED_COUNT = 12
 LED_BRIGHTNESS = 50
 
 PIXEL_MAP = {0: 3, 1: 6, 2: 8, 3: 11}
-
-# ADS settling (vigtigt ved høj impedans)
-ADS_DUMMY_SLEEP = 0.01    # 10 ms efter dummy read
-ADS_BETWEEN_SLEEP = 0.01  # 10 ms mellem kanaler
+# Startværdi for den huskede frame (hw["frame"]) – stripen er slukket ved init
+OFF_FRAME = (Color(0, 0, 0),) * LED_COUNT
+
+# Statiske OLED-labels (position, tekst) – værdierne tegnes lige efter hver label
+OLED_LABELS = (
+    ((0, 10), "R0:"), ((64, 10), "R1:"),
+    ((0, 20), "R2:"), ((64, 20), "R3:"),
+    ((0, 35), "V:"), ((64, 35), "I:"),
+)
+
+# ADS1115 registre + config-bits
+ADS_REG_CONVERSION = 0x00
+ADS_REG_CONFIG = 0x01
+ADS_OS_START = 0x8000      # start single-shot konvertering / læst: 1 = klar
+ADS_PGA_4_096V = 0x0200    # gain 1 => +/-4.096V
+ADS_MODE_SINGLE = 0x0100
+ADS_DR_860SPS = 0x00E0     # ~1.2 ms pr. konvertering (128 SPS = ~7.8 ms)
+ADS_COMP_DISABLE = 0x0003
+
+# Færdige config-writes pr. kanal: [pointer, MSB, LSB] (AIN0..AIN3 mod GND)
+ADS_CONFIG_BYTES = tuple(
+    bytes([ADS_REG_CONFIG, (cfg >> 8) & 0xFF, cfg & 0xFF])
+    for cfg in (
+        ADS_OS_START | ((0x4 + ch) << 12) | ADS_PGA_4_096V | ADS_MODE_SINGLE | ADS_DR_860SPS | ADS_COMP_DISABLE
+        for ch in range(4)
+    )
+)
+
+# Gain=1 => 4.096V fuld skala (32768 counts)
+ADC_VOLTS_PER_COUNT = 4.096 / 32768.0
+
+ADS_CONVERSION_TIME = 1.0 / 860  # nominel konverteringstid ved 860 SPS
+ADS_READY_TIMEOUT = 0.05  # 50 ms før vi giver op på en konvertering
 ADS_SAMPLES = 3           # gennemsnit (stabilt)
 
+# INA219 registre
+INA_REG_BUS_VOLTAGE = 0x02
+INA_REG_CURRENT = 0x04
+INA_BUS_VOLTS_PER_LSB = 0.004  # 4 mV pr. LSB (bit 15..3)
+INA_BUS_OVF = 0x0001           # bit 0: strøm/effekt-beregningen er overløbet
+
+PRECISE_SLEEP_MAX = 0.002  # kortere ventetider busy-waites i stedet for time.sleep
+
 
 # --------------------------
 # HELPERS
 # --------------------------
+def precise_sleep(seconds: float) -> None:
+    """
+    Vent præcist i kort tid.
+
+    time.sleep kan oversove flere ms på Pi'en, så korte ventetider
+    (under PRECISE_SLEEP_MAX) spinnes på perf_counter i stedet.
+    """
+    if seconds >= PRECISE_SLEEP_MAX:
+        time.sleep(seconds)
+        return
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def read_register_word(bus, address: int, register: int) -> int:
+    """Pointer-write + 2-byte read (big-endian) i én transaktion (repeated start)."""
+    write = smbus2.i2c_msg.write(address, [register])
+    read = smbus2.i2c_msg.read(address, 2)
+    bus.i2c_rdwr(write, read)
+    msb, lsb = list(read)
+    return (msb << 8) | lsb
+
+
+def read_ina219(bus, ina):
+    """
+    Læs busspænding (V) og strøm (mA) fra INA219 direkte på den delte bus.
+
+    Hvert register læses med read_register_word. De to registre kan ikke
+    samles i ét i2c_rdwr – Pi'ens I2C-driver tillader kun én read-besked,
+    og den skal være sidst. Strømmen skaleres med den current_lsb, som
+    ina.configure() har kalibreret.
+
+    Ved overløb (OVF-bit i bus-registret) bruges ina.current() i stedet:
+    med GAIN_AUTO hæver biblioteket selv gain'en og kalibrerer om, så
+    strømmen ikke returneres mættet.
+    """
+    bus_word = read_register_word(bus, I2C_ADDR_INA219, INA_REG_BUS_VOLTAGE)
+    bus_voltage = (bus_word >> 3) * INA_BUS_VOLTS_PER_LSB
+
+    if bus_word & INA_BUS_OVF:
+        return bus_voltage, ina.current()
+
+    raw = read_register_word(bus, I2C_ADDR_INA219, INA_REG_CURRENT)
+    if raw & 0x8000:
+        raw -= 0x10000
+    current = raw * ina._current_lsb * 1000
+    return bus_voltage, current
+
+
+def check_i2c_clock() -> None:
+    """Advar hvis I2C-bussen ikke kører fast-mode (400 kHz)."""
+    try:
+        with open(I2C_CLOCK_PATH, "rb") as f:
+            clock = int.from_bytes(f.read(4), "big")
+    except OSError:
+        print("I2C: kunne ikke læse busfrekvens fra", I2C_CLOCK_PATH)
+        return
+
+    if clock < I2C_BAUDRATE:
+        print(f"I2C: bus kører {clock // 1000} kHz – sæt i2c_arm_baudrate={I2C_BAUDRATE} i config.txt")
+
+
 def adc_counts_to_volts(raw_counts: int) -> float:
-    # Gain=1 => 4.096V fuld skala (32768 counts)
-    return float(raw_counts) * (4.096 / 32768.0)
+    return float(raw_counts) * ADC_VOLTS_PER_COUNT
+
+
+class ADS1115:
+    """
+    Lille ADS1115-driver direkte på smbus2.
+
+    Hver læsning starter en single-shot konvertering på den valgte kanal og
+    poller OS-bittet i config-registret, til sample er klar – i stedet for
+    at sove en fast worst-case tid.
+    """
+
+    def __init__(self, bus, address: int = I2C_ADDR_ADS1115):
+        self.bus = bus
+        self.address = address
+
+    def _read_register(self, register: int) -> int:
+        return read_register_word(self.bus, self.address, register)
+
+    def read_adc(self, channel: int) -> int:
+        # Config-write skal afsluttes med STOP før konverteringen starter
+        self.bus.i2c_rdwr(smbus2.i2c_msg.write(self.address, ADS_CONFIG_BYTES[channel]))
+
+        # Vent den nominelle konverteringstid, så bussen ikke belastes af
+        # polls der alligevel ikke kan lykkes; OS-bit (bit 15) går høj når
+        # konverteringen er færdig
+        precise_sleep(ADS_CONVERSION_TIME)
+        deadline = time.monotonic() + ADS_READY_TIMEOUT
+        while not self._read_register(ADS_REG_CONFIG) & ADS_OS_START:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"ADS1115 kanal {channel}: ingen konvertering")
+            time.sleep(0)
+
+        raw = self._read_register(ADS_REG_CONVERSION)
+        return raw - 0x10000 if raw & 0x8000 else raw
+
+
+def build_oled_background(oled):
+    """
+    Forhåndstegn de statiske dele af resultatskærmen.
+
+    Returnerer (billede, positioner), hvor positioner er hvor de dynamiske
+    værdier skal tegnes – i samme rækkefølge som OLED_LABELS.
+    """
+    bg = Image.new(oled.mode, oled.size)
+    draw = ImageDraw.Draw(bg)
+    draw.text((0, 0), "MOSFET: ON", fill="white")
+
+    positions = []
+    for (x, y), label in OLED_LABELS:
+        draw.text((x, y), label, fill="white")
+        positions.append((x + int(draw.textlength(label)), y))
+    return bg, positions
 
 
 def initialize_hardware():
+    # Én SMBus-handle deles af ADS1115 og INA219-målingerne i hele processens levetid
+    check_i2c_clock()
     bus = smbus2.SMBus(I2C_PORT)
+    atexit.register(bus.close)
 
+    # OLED'en får sin egen handle: kun når luma selv ejer bussen, sendes en
+    # hel frame som én i2c_rdwr-besked (med en delt bus bliver det 32 små
+    # block-writes pr. frame)
     serial = i2c(port=I2C_PORT, address=I2C_ADDR_OLED)
     oled = ssd1306(serial)
     with canvas(oled) as draw:
@@ -71,7 +247,7 @@ def initialize_hardware():
     ina = INA219(0.1, busnum=I2C_PORT, address=I2C_ADDR_INA219)
     ina.configure()
 
-    ads = Adafruit_ADS1x15.ADS1115(address=I2C_ADDR_ADS1115, busnum=I2C_PORT)
+    ads = ADS1115(bus, address=I2C_ADDR_ADS1115)
 
     # OBS: aktiv HIGH/LOW afhænger af jeres MOSFET wiring.
     mosfet = OutputDevice(MOSFET_PIN, active_high=False, initial_value=False)
@@ -80,60 +256,75 @@ def initialize_hardware():
     if ENABLE_NEOPIXELS:
         strip = PixelStrip(LED_COUNT, NEOPIXEL_PIN, 800000, 10, False, LED_BRIGHTNESS, 0)
         strip.begin()
-        for i in range(strip.numPixels()):
-            strip.setPixelColor(i, Color(0, 0, 0))
+        # Én skalar slukker alle pixels (rpi_ws281x sætter samme værdi pr. index)
+        strip[:] = Color(0, 0, 0)
         strip.show()
 
-    return {"bus": bus, "oled": oled, "ina": ina, "ads": ads, "mosfet": mosfet, "strip": strip}
+    return {
+        "bus": bus,
+        "oled": oled,
+        "oled_bg": build_oled_background(oled),
+        "ina": ina,
+        "ads": ads,
+        "mosfet": mosfet,
+        "strip": strip,
+        "frame": list(OFF_FRAME),
+    }
+
+
+_HW = None
+_HW_LOCK = threading.Lock()
+
+
+def get_hardware():
+    """
+    Returnér de delte hardware-handles.
+
+    Hardwaren initialiseres kun første gang (ikke pr. request), så
+    /start-test kun betaler for selve målingen.
+    """
+    global _HW
+    if _HW is None:
+        with _HW_LOCK:
+            if _HW is None:
+                _HW = initialize_hardware()
+    return _HW
 
 
 def read_adc_stable(channel: int, ads) -> float:
     """
-    Stabil læsning:
-      1) dummy read (skifter mux)
-      2) kort sleep så sample/hold kan falde til ro
-      3) flere samples + gennemsnit
+    Stabil læsning: flere samples + gennemsnit.
+
+    Hver read_adc programmerer mux'en og starter en ny single-shot
+    konvertering bagefter, så første sample efter kanalskift er gyldigt
+    – der er ingen dummy read og ingen settling-sleep.
     """
-    _ = ads.read_adc(channel, gain=ADS_GAIN)  # dummy
-    time.sleep(ADS_DUMMY_SLEEP)
-
-    total = 0.0
-    for _ in range(ADS_SAMPLES):
-        total += ads.read_adc(channel, gain=ADS_GAIN)
-        time.sleep(0.002)
-    return total / ADS_SAMPLES
-
-
-def measure_channel(channel: int, ads, v_in: float):
-    raw = read_adc_stable(channel, ads)
-    v_adc = adc_counts_to_volts(int(raw))
-
-    if v_adc <= 0.01 or v_adc >= v_in:
-        r = OPEN_CIRCUIT_OHMS
-    else:
-        rs = RS_VALUES[channel]
-        r = rs * ((v_in - v_adc) / v_adc)
-        if r < 0:
-            r = OPEN_CIRCUIT_OHMS
-
-    if r >= OPEN_CIRCUIT_OHMS:
-        status = "FAIL"
-        color = Color(0, 0, 255)
-    elif r <= GOOD_MAX:
-        status = "GOOD"
-        color = Color(0, 255, 0)
-    elif r <= OK_MAX:
-        status = "OK"
-        color = Color(255, 255, 0)
-    elif r <= BAD_MAX:
-        status = "BAD"
-        color = Color(255, 0, 0)
-    else:
-        status = "FAIL"
-        color = Color(0, 0, 255)
-
-    print(f"Ch{channel}: V={v_adc:.6f}V | R={r:.1f} Ohm | {status}")
-    return channel, float(v_adc), float(r), status, color
+    # Samples tages back-to-back ved 860 SPS – ingen sleep imellem
+    return sum(ads.read_adc(channel) for _ in range(ADS_SAMPLES)) / ADS_SAMPLES
+
+
+def measure_channels(channels, ads, v_in: float):
+    """
+    Mål alle kanaler i ét sweep.
+
+    Returnerer (voltages, resistances, statuses, colors) som lister i
+    samme rækkefølge som channels.
+    """
+    voltages = [adc_counts_to_volts(int(read_adc_stable(ch, ads))) for ch in channels]
+
+    # v_adc udenfor (0.01, v_in) => åben kreds
+    resistances = [
+        RS_VALUES[ch] * ((v_in - v) / v) if 0.01 < v < v_in else OPEN_CIRCUIT_OHMS
+        for ch, v in zip(channels, voltages)
+    ]
+
+    levels = [STATUS_LEVELS[bisect_left(STATUS_THRESHOLDS, r)] for r in resistances]
+    statuses = [status for status, _ in levels]
+    colors = [color for _, color in levels]
+
+    for ch, v, r, status in zip(channels, voltages, resistances, statuses):
+        print(f"Ch{ch}: V={v:.6f}V | R={r:.1f} Ohm | {status}")
+    return voltages, resistances, statuses, colors
 
 
 # --------------------------
@@ -142,7 +333,23 @@ def measure_channel(channel: int, ads, v_in: float):
 app = APIFlask(__name__)
 
 
+class StartTestQuery(Schema):
+    # n = antal målinger i samme kald (MOSFET'en er tændt under dem alle)
+    n = Integer(load_default=1, validate=Range(min=1, max=MAX_SAMPLES_PER_TEST))
+
+
+class SampleOut(Schema):
+    # elapsed = sekunder siden første måling i kaldet
+    elapsed = Float()
+    voltages = List(Float)
+    resistances = List(Float)
+    statuses = List(String)
+    bus_voltage = Float()
+    current = Float()
+
+
 class StartTestOut(Schema):
+    # Topniveau-felterne er den sidste måling; samples har dem alle
     message = String()
     channels = List(Integer)
     voltages = List(Float)
@@ -151,12 +358,14 @@ class StartTestOut(Schema):
     electrode_count = Integer()
     bus_voltage = Float()
     current = Float()
+    samples = List(Nested(SampleOut))
 
 
 @app.post("/start-test")
+@app.input(StartTestQuery, location="query")
 @app.output(StartTestOut)
-def start_test():
-    hw = initialize_hardware()
+def start_test(query_data):
+    hw = get_hardware()
     oled = hw["oled"]
     ina = hw["ina"]
     ads = hw["ads"]
@@ -166,38 +375,52 @@ def start_test():
     mosfet.on()
     time.sleep(0.2)
 
-    bus_voltage = float(ina.voltage())
-    current = float(ina.current())
+    channels = [0, 1, 2, 3]
+    samples = []
+    start = time.monotonic()
 
-    v_in_used = bus_voltage if bus_voltage > 2.5 else V_IN_FALLBACK
-    print(f"INA219: {bus_voltage:.2f}V, {current:.2f}mA")
+    for _ in range(query_data["n"]):
+        elapsed = time.monotonic() - start
+        bus_voltage, current = read_ina219(hw["bus"], ina)
 
-    channels = [0, 1, 2, 3]
-    voltages = [0.0] * 4
-    resistances = [0.0] * 4
-    statuses = ["N/A"] * 4
-    colors = [Color(0, 0, 0)] * 4
-
-    # ADS1115 læses sekventielt (ikke threadpool)
-    for ch in channels:
-        ch, v, r, st, col = measure_channel(ch, ads, v_in_used)
-        voltages[ch] = v
-        resistances[ch] = r
-        statuses[ch] = st
-        colors[ch] = col
-        time.sleep(ADS_BETWEEN_SLEEP)
+        v_in_used = bus_voltage if bus_voltage > 2.5 else V_IN_FALLBACK
+        print(f"INA219: {bus_voltage:.2f}V, {current:.2f}mA")
+
+        # ADS1115 læses sekventielt (ikke threadpool)
+        voltages, resistances, statuses, colors = measure_channels(channels, ads, v_in_used)
+        samples.append({
+            "elapsed": elapsed,
+            "voltages": voltages,
+            "resistances": resistances,
+            "statuses": statuses,
+            "bus_voltage": bus_voltage,
+            "current": current,
+        })
+
+    # Neopixels og OLED viser den sidste måling
 
     if strip and ENABLE_NEOPIXELS:
+        # Framen huskes mellem requests: kun ændrede pixels skrives,
+        # og show() springes over hvis intet er ændret
+        frame = hw["frame"]
+        changed = False
         for ch in channels:
             pix = PIXEL_MAP[ch]
-            strip.setPixelColor(pix, colors[ch])
-        strip.show()
-
-    with canvas(oled) as draw:
-        draw.text((0, 0), "MOSFET: ON", fill="white")
-        draw.text((0, 10), f"R0:{resistances[0]/1000:.1f}k R1:{resistances[1]/1000:.1f}k", fill="white")
-        draw.text((0, 20), f"R2:{resistances[2]/1000:.1f}k R3:{resistances[3]/1000:.1f}k", fill="white")
-        draw.text((0, 35), f"V:{bus_voltage:.2f}V I:{current:.1f}mA", fill="white")
+            if frame[pix] != colors[ch]:
+                frame[pix] = colors[ch]
+                strip.setPixelColor(pix, colors[ch])
+                changed = True
+        if changed:
+            strip.show()
+
+    # Kun værdierne tegnes – labels ligger i den forhåndstegnede baggrund
+    bg, positions = hw["oled_bg"]
+    img = bg.copy()
+    draw = ImageDraw.Draw(img)
+    values = [f"{r/1000:.1f}k" for r in resistances] + [f"{bus_voltage:.2f}V", f"{current:.1f}mA"]
+    for pos, text in zip(positions, values):
+        draw.text(pos, text, fill="white")
+    oled.display(img)
 
     return {
         "message": "Test completed on Raspberry Pi",
@@ -208,8 +431,10 @@ def start_test():
         "electrode_count": 4,
         "bus_voltage": bus_voltage,
         "current": current,
+        "samples": samples,
     }
 
 
+# Produktion kører under gunicorn (se activate.sh); app.run kun til lokal test
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5001, debug=True)
+    app.run(host="0.0.0.0", port=5001)
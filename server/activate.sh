@@ -3,4 +3,4 @@
 sleep 30
 source /home/services/.venv/bin/activate 2>/home/services/source.log
 cd /home/services/webpage
-python /home/services/webpage/app.py 2>/home/services/app.log
+gunicorn -c gunicorn_conf.py app:app 2>/home/services/app.log
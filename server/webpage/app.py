@@ -1,20 +1,73 @@
+import atexit
+import collections
+import functools
+import hashlib
+import os
 import secrets
-from datetime import datetime
+import threading
+import time
+import uuid
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import MappingProxyType
 import yaml
+import orjson
 import psycopg
 import requests
-from flask import render_template
-from apiflask import APIFlask, Schema
-from apiflask.fields import List, String, Float, Integer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool
+from flask import Response, render_template, request
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+from flask_compress import Compress
+from apiflask import APIFlask, Schema, abort
+from apiflask.validators import Range
+from apiflask.fields import List, String, Float, Integer, DateTime, Nested
 
 
 # --------------------------------------------------
 # Indlæs konfiguration fra YAML
 # --------------------------------------------------
-def load_config(path: str = "config.yaml") -> dict:
-    """Åbn config.yaml og returnér indholdet som et dict."""
+# libyaml's C-parser hvis PyYAML er bygget med den, ellers den rene Python-parser
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+
+def _freeze(value):
+    """Gør YAML-data read-only hele vejen ned: dict -> MappingProxyType, list -> tuple."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+@functools.lru_cache(maxsize=8)
+def _load_config_cached(path: str, signature: tuple) -> Mapping:
+    """
+    Parse YAML-filen – signature er kun med i cache-nøglen.
+
+    Resultatet deles af alle kald, så det fryses rekursivt; ellers kunne
+    en ændring af fx config["database"] slå igennem i næste load_config().
+    """
     with open(path, "r", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+        return _freeze(yaml.load(f, Loader=YamlLoader) or {})
+
+
+def load_config(path: str = "config.yaml") -> Mapping:
+    """
+    Returnér config.yaml som et read-only mapping (også de indlejrede sektioner).
+
+    Filen parses kun igen, hvis den er ændret siden sidst (os.stat i stedet
+    for open + YAML-parse ved hver import). Nøglen er (mtime, størrelse,
+    inode), så også atomiske gem (ny fil + rename) opdages.
+    """
+    st = os.stat(path)
+    return _load_config_cached(path, (st.st_mtime_ns, st.st_size, st.st_ino))
 
 
 config = load_config()
@@ -26,27 +79,295 @@ RASPI_CFG = config.get("raspberry", {})
 SENSOR_NAME = FLASK_CFG.get("SENSOR_NAME", "EEG Electrode Test")
 SENSOR_UNIT = FLASK_CFG.get("SENSOR_UNIT", "Ohm")
 
+# Vi har altid 4 kanaler i vores setup: 0,1,2,3
+SENSOR_CHANNELS = (0, 1, 2, 3)
+# Som JSON-literal til SQL'en i /api/sensor-data
+SENSOR_CHANNELS_JSON = orjson.dumps(SENSOR_CHANNELS).decode()
+
+# Svar fra /api/sensor-data ved DB-fejl: gyldig JSON med tomme lister,
+# så frontend/Plotly ikke crasher. Bygges én gang (konstant indhold).
+EMPTY_SENSOR_DATA = {
+    "timestamps": (),
+    "channels": (),
+    "ch0": (),
+    "ch1": (),
+    "ch2": (),
+    "ch3": (),
+    "bus_voltage": (),
+    "current": (),
+    "sensor_name": SENSOR_NAME,
+    "unit": SENSOR_UNIT,
+    "count": 0,
+}
+
+# Max rækker pr. /api/sensor-data-svar (uden ?since= de nyeste; nye hentes med ?since=)
+SENSOR_MAX_ROWS = 50_000
+# Antal punkter ?bucket=0 (auto) sigter efter
+SENSOR_TARGET_POINTS = 1000
+# Timestamps formateres som ISO 8601 af PostgreSQL (to_char) – samme form
+# som datetime.isoformat(), men altid med mikrosekunder og uden tidszone
+# (test_timestamp er lokal tid uden zone).
+SQL_ISO_FORMAT = 'YYYY-MM-DD"T"HH24:MI:SS.US'
+
 # --------------------------------------------------
 # Opret APIFlask-app
 # --------------------------------------------------
+class ORJSONProvider(JSONProvider):
+    """
+    JSON-provider der serialiserer med orjson (C) i stedet for stdlib json.
+
+    Typer orjson ikke selv kender (fx Decimal) håndteres som i Flasks
+    standard-provider.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = APIFlask(__name__)
+app.json = ORJSONProvider(app)
 app.config["SECRET_KEY"] = FLASK_CFG.get("SECRET_KEY", secrets.token_bytes(32))
 
+# Komprimér JSON-svar (lange float-/timestamp-lister komprimerer godt)
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 1024
+Compress(app)
+
 
 # --------------------------------------------------
-# DB helper (psycopg3)
+# DB connection pool (psycopg3)
 # --------------------------------------------------
+DB_CONNINFO = make_conninfo(
+    user=DB_CFG.get("user", "postgres"),
+    password=DB_CFG.get("password", "sander12"),
+    host=DB_CFG.get("host", "127.0.0.1"),
+    port=DB_CFG.get("port", "5432"),
+    dbname=DB_CFG.get("dbname", "hospital"),
+)
+
+# Forbindelserne holdes åbne mellem requests, så vi kun betaler for
+# TCP + auth-handshake når poolen vokser.
+# Størrelsen kan sættes under database: i config.yaml (pool_min_size/pool_max_size).
+POOL = ConnectionPool(
+    DB_CONNINFO,
+    min_size=int(DB_CFG.get("pool_min_size", 4)),
+    max_size=int(DB_CFG.get("pool_max_size", 20)),
+    timeout=10,
+    kwargs={"autocommit": True},
+    open=True,
+)
+atexit.register(POOL.close)
+
+
 def get_db_connection():
-    """Opret og returnér en ny psycopg3-forbindelse til PostgreSQL."""
-    connection = psycopg.connect(
-        user=DB_CFG.get("user", "postgres"),
-        password=DB_CFG.get("password", "sander12"),
-        host=DB_CFG.get("host", "127.0.0.1"),
-        port=DB_CFG.get("port", "5432"),
-        dbname=DB_CFG.get("dbname", "hospital"),
-    )
-    connection.autocommit = True
-    return connection
+    """Lån en forbindelse fra poolen – bruges som context manager."""
+    return POOL.connection()
+
+
+def ensure_indexes():
+    """
+    Opret index på test_timestamp (én gang ved opstart), så ?since=-
+    opslag i /api/sensor-data bliver et range-scan i stedet for hele tabellen.
+
+    Indexet indeholder (INCLUDE) også de kolonner /api/sensor-data læser,
+    så forespørgslen kan køre som index-only scan uden at røre tabellen.
+
+    CONCURRENTLY: første opbygning blokerer ikke for nye målinger. Det
+    kræver autocommit, som poolens forbindelser allerede kører med.
+    """
+    try:
+        with get_db_connection() as connection:
+            connection.execute(
+                """
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS em_ts_cover_idx
+                    ON Electrode_Measurements (test_timestamp)
+                    INCLUDE (ch0_resistance, ch1_resistance, ch2_resistance,
+                             ch3_resistance, bus_voltage, current)
+                """
+            )
+    except (Exception, psycopg.Error) as error:
+        print("Error while creating timestamp index:", error)
+
+ensure_indexes()
+
+
+# --------------------------------------------------
+# Batch-skrivning af målinger (COPY)
+# --------------------------------------------------
+COPY_MEASUREMENTS = """
+    COPY Electrode_Measurements
+        (test_timestamp,
+         ch0_resistance,
+         ch1_resistance,
+         ch2_resistance,
+         ch3_resistance,
+         bus_voltage,
+         current,
+         electrode_count)
+    FROM STDIN
+"""
+
+FLUSH_INTERVAL = 0.1     # sekunder mellem baggrunds-flushes
+FLUSH_BATCH_SIZE = 1000  # max rækker pr. COPY
+
+SENSOR_CACHE_TTL = 2.0   # sekunder /api/sensor-data-svaret genbruges
+
+# Målinger der venter på at blive skrevet (én tuple pr. række)
+_PENDING: collections.deque = collections.deque()
+_FLUSH_LOCK = threading.Lock()
+
+# Seneste /api/sensor-data-svar som færdig JSON (hele historikken er ét globalt payload)
+_SENSOR_CACHE = {"body": None, "etag": None, "expires": 0.0, "generation": 0}
+_SENSOR_CACHE_LOCK = threading.Lock()
+
+
+def invalidate_sensor_cache():
+    """Glem det cachede /api/sensor-data-svar, så næste kald læser fra DB."""
+    with _SENSOR_CACHE_LOCK:
+        _SENSOR_CACHE["body"] = None
+        _SENSOR_CACHE["etag"] = None
+        _SENSOR_CACHE["generation"] += 1
+
+
+def _copy_rows(cursor, rows):
+    """Skriv rows med én COPY på cursorens forbindelse."""
+    with cursor.copy(COPY_MEASUREMENTS) as copy:
+        for row in rows:
+            copy.write_row(row)
+
+
+def flush_measurements():
+    """
+    Skriv alle ventende målinger til Electrode_Measurements.
+
+    Rækkerne sendes med én COPY pr. batch i stedet for én INSERT pr. måling.
+    Kaldes af baggrundstråden og før /api/sensor-data læser, så nye tests
+    altid er med i grafen.
+
+    Afviser databasen batchen (fx en ugyldig værdi), prøves rækkerne én ad
+    gangen, så kun de dårlige rækker går tabt. Er databasen nede, lægges
+    batchen tilbage forrest i køen til næste flush.
+    """
+    with _FLUSH_LOCK:
+        while _PENDING:
+            batch = []
+            while _PENDING and len(batch) < FLUSH_BATCH_SIZE:
+                batch.append(_PENDING.popleft())
+
+            done = 0  # rækker fra batch der er skrevet eller kasseret
+            try:
+                with get_db_connection() as connection, connection.cursor() as cursor:
+                    try:
+                        _copy_rows(cursor, batch)
+                        done = len(batch)
+                    except psycopg.OperationalError:
+                        raise
+                    except (Exception, psycopg.Error) as batch_error:
+                        print("Batch COPY failed, retrying row by row:", batch_error)
+                        for row in batch:
+                            try:
+                                _copy_rows(cursor, (row,))
+                            except psycopg.OperationalError:
+                                raise
+                            except (Exception, psycopg.Error) as row_error:
+                                print("Dropping invalid electrode measurement:", row, row_error)
+                            done += 1
+
+            except (Exception, psycopg.Error) as db_error:
+                # Forbindelsen/poolen fejlede: behold de uskrevne rækker
+                # forrest i køen (i samme rækkefølge) til næste flush
+                print("Error while inserting electrode measurements:", db_error)
+                _PENDING.extendleft(reversed(batch[done:]))
+                if done:
+                    invalidate_sensor_cache()
+                return
+
+            invalidate_sensor_cache()
+
+
+def _flusher():
+    """Baggrundstråd: flush ventende målinger hvert FLUSH_INTERVAL sekund."""
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        if _PENDING:
+            flush_measurements()
+
+
+threading.Thread(target=_flusher, name="measurement-flusher", daemon=True).start()
+atexit.register(flush_measurements)
+
+
+# --------------------------------------------------
+# HTTP-klient til Raspberry Pi (RPC)
+# --------------------------------------------------
+PI_URL = f"http://{RASPI_CFG.get('host', '127.0.0.1')}:{RASPI_CFG.get('port', 5001)}/start-test"
+
+# Max målinger pr. RPC-kald (?n=K) – samme grænse som i test.py på Pi'en
+MAX_SAMPLES_PER_TEST = 100
+
+# Én session med keep-alive, så TCP-forbindelsen til Pi'en genbruges.
+# Kun fejl under connect prøves igen (POST'en er ikke nået frem til Pi'en);
+# en afbrudt måling (read) gentages ikke.
+PI_RETRY = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2)
+PI_SESSION = requests.Session()
+PI_SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=16, max_retries=PI_RETRY))
+
+# (connect, read): en slukket Pi opdages på 0.5 s, mens selve målingen må tage 10 s
+PI_TIMEOUT = (0.5, 10)
+
+
+class CircuitBreaker:
+    """
+    Simpel circuit breaker til Pi-kaldet.
+
+    Efter max_fail fejl i træk afvises kald i cooldown sekunder, så hvert
+    klik ikke venter på en timeout mens Pi'en er nede. Efter cooldown
+    (half-open) slipper præcis ét prøvekald igennem; de andre afvises til
+    det er afgjort. Lykkes prøvekaldet, lukkes breakeren – fejler det,
+    åbnes den igen i cooldown sekunder.
+    """
+
+    def __init__(self, max_fail=3, cooldown=5.0):
+        self.max_fail = max_fail
+        self.cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if now < self._open_until:
+                return False
+            if self._failures >= self.max_fail:
+                # Half-open: dette kald er prøven; resten venter en cooldown
+                # mere (eller til record() har afgjort den)
+                self._open_until = now + self.cooldown
+            return True
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self._failures = 0
+                self._open_until = 0.0
+                return
+            self._failures += 1
+            if self._failures >= self.max_fail:
+                self._open_until = time.monotonic() + self.cooldown
+
+
+PI_BREAKER = CircuitBreaker(max_fail=3, cooldown=5.0)
+
+
+# RPC-kald kører i baggrunden, så en HTTP-worker ikke holdes i op til 10 s.
+# Jobs gemmes (job_id -> (Future, oprettet)) indtil de er ældre end JOB_TTL.
+JOB_TTL = 300.0
+RPC_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pi-rpc")
+_JOBS: collections.OrderedDict = collections.OrderedDict()
+_JOBS_LOCK = threading.Lock()
 
 
 # --------------------------------------------------
@@ -79,15 +400,50 @@ class SensorDataOut(Schema):
     count = Integer()
 
 
+class SensorDataQuery(Schema):
+    """
+    Query-parametre til /api/sensor-data.
+
+      - since: returnér kun tests efter dette tidspunkt (ISO). Frontend
+        sender den seneste timestamp den allerede har, så kun nye rækker
+        hentes.
+      - bucket: nedsampl i PostgreSQL til gennemsnit pr. bucket-sekunder.
+        0 vælger selv en bucket-størrelse, så svaret bliver ca.
+        SENSOR_TARGET_POINTS punkter uanset tabellens størrelse.
+      - limit: max rækker/buckets i svaret (1..SENSOR_MAX_ROWS).
+    """
+    since = DateTime(load_default=None)
+    bucket = Integer(load_default=None, validate=Range(min=0))
+    limit = Integer(load_default=SENSOR_MAX_ROWS, validate=Range(min=1, max=SENSOR_MAX_ROWS))
+
+
+class RemoteStartQuery(Schema):
+    """
+    Query-parametre til POST /api/start-remote-test.
+
+      - n: antal målinger Pi'en tager i samme RPC-kald (gemmes samlet)
+    """
+    n = Integer(load_default=1, validate=Range(min=1, max=MAX_SAMPLES_PER_TEST))
+
+
+class RemoteSampleOut(Schema):
+    """Én måling fra et batch-kald (timestamp = hvornår den blev gemt)."""
+    timestamp = String()
+    resistances = List(Float)
+    bus_voltage = Float()
+    current = Float()
+
+
 class RemoteStartOut(Schema):
     """
     Svar fra Raspberry Pi RPC-kaldet (én ny test).
 
     Dette schema matcher JSON fra test.py på Pi'en:
       message, channels, voltages, resistances, statuses,
-      electrode_count, bus_voltage, current
+      electrode_count, bus_voltage, current, samples
 
-    Vi tilføjer også timestamp for den gemte række.
+    Topniveau-felterne er den sidste måling; samples indeholder alle n
+    målinger med det timestamp, de blev gemt med.
     """
     message = String()
     timestamp = String()
@@ -99,6 +455,49 @@ class RemoteStartOut(Schema):
     bus_voltage = Float()
     current = Float()
     unit = String()
+    samples = List(Nested(RemoteSampleOut))
+
+
+class RemoteJobOut(Schema):
+    """
+    Status for en remote test, der kører i baggrunden.
+
+      - job_id: id til GET /api/job/<job_id>
+      - status: "pending" mens Pi'en måler, "done" når result er klar
+      - result: RemoteStartOut-data (kun når status er "done")
+    """
+    job_id = String()
+    status = String()
+    result = Nested(RemoteStartOut, allow_none=True)
+
+
+def make_etag(body: bytes) -> str:
+    """ETag ud fra indholdet – samme data giver samme tag, også efter genstart."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def json_response(body: bytes, etag: str | None = None) -> Response:
+    """
+    Pak færdigserialiseret JSON ind i en Response.
+
+    APIFlask springer @app.output-serialiseringen over for Response-objekter,
+    så store payloads ikke valideres element for element af marshmallow.
+
+    Med etag svares 304 Not Modified (uden body), hvis browseren allerede
+    har præcis dette svar (If-None-Match).
+    """
+    if etag is not None:
+        # Flask-Compress sætter ":br"/":gzip" på ETag'en for komprimerede svar
+        known = {tag.split(":", 1)[0] for tag in request.if_none_match.as_set()}
+        if etag in known:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+    response = Response(body, mimetype="application/json")
+    if etag is not None:
+        response.set_etag(etag)
+    return response
 
 
 # --------------------------------------------------
@@ -114,8 +513,9 @@ def index():
 # API: læs historiske tests fra Electrode_Measurements
 # --------------------------------------------------
 @app.get("/api/sensor-data")
-@app.output(SensorDataOut)
-def get_sensor_data():
+@app.input(SensorDataQuery, location="query")
+@app.output(SensorDataOut)  # kun OpenAPI-dokumentation – svaret er en færdig Response
+def get_sensor_data(query_data):
     """
     Henter data fra Electrode_Measurements-tabellen og sender dem til frontend.
 
@@ -127,131 +527,179 @@ def get_sensor_data():
       ch3_resistance   -> ch3
       bus_voltage      -> bus_voltage
       current          -> current
-    """
 
-    timestamps: list[str] = []
-    ch0_list: list[float] = []
-    ch1_list: list[float] = []
-    ch2_list: list[float] = []
-    ch3_list: list[float] = []
-    bus_list: list[float] = []
-    curr_list: list[float] = []
-
-    connection = None
-    cursor = None
+    Uden ?since= returneres de nyeste SENSOR_MAX_ROWS tests.
+    Med ?since= returneres kun tests nyere end tidspunktet (max
+    SENSOR_MAX_ROWS pr. svar); frontend hænger dem på det den har.
+    Med ?bucket= returneres gennemsnit pr. tidsbucket i stedet for rå rækker.
+    Med ?limit= kan svaret gøres mindre end SENSOR_MAX_ROWS.
+    """
+    since = query_data["since"]
+    bucket = query_data["bucket"]
+    limit = query_data["limit"]
+    cacheable = since is None and bucket is None and limit == SENSOR_MAX_ROWS
+
+    where_clause = "WHERE test_timestamp > %(since)s" if since is not None else ""
+    # Uden ?since= er det de nyeste rækker, der skal med, når LIMIT rammes
+    # (json_agg nedenfor sorterer dem stigende igen). Med ?since= hentes de
+    # ældste nye først, så næste ?since= fortsætter hvor svaret sluttede.
+    order = "ASC" if since is not None else "DESC"
+
+    if bucket is None:
+        rows_query = f"""
+            SELECT to_char(test_timestamp, '{SQL_ISO_FORMAT}') AS ts,
+                   COALESCE(ch0_resistance, 0)::float8 AS ch0,
+                   COALESCE(ch1_resistance, 0)::float8 AS ch1,
+                   COALESCE(ch2_resistance, 0)::float8 AS ch2,
+                   COALESCE(ch3_resistance, 0)::float8 AS ch3,
+                   COALESCE(bus_voltage, 0)::float8 AS bus,
+                   COALESCE(current, 0)::float8 AS curr
+            FROM Electrode_Measurements
+            {where_clause}
+            ORDER BY test_timestamp {order}
+            LIMIT %(limit)s
+        """
+    else:
+        if bucket > 0:
+            bucket_secs = "%(bucket)s::float8"
+        else:
+            # Auto: tidsspændet delt i ca. SENSOR_TARGET_POINTS buckets (min. 1 s)
+            bucket_secs = f"""
+                GREATEST(1, (SELECT extract(epoch FROM max(test_timestamp) - min(test_timestamp))::float8
+                             FROM Electrode_Measurements
+                             {where_clause}) / %(points)s)
+            """
 
-    try:
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        select_query = """
-            SELECT test_timestamp,
-                   ch0_resistance,
-                   ch1_resistance,
-                   ch2_resistance,
-                   ch3_resistance,
-                   bus_voltage,
-                   current
+        rows_query = f"""
+            SELECT to_char(date_bin(make_interval(secs => {bucket_secs}),
+                                    test_timestamp,
+                                    TIMESTAMP '2000-01-01'),
+                           '{SQL_ISO_FORMAT}') AS ts,
+                   COALESCE(AVG(ch0_resistance), 0)::float8 AS ch0,
+                   COALESCE(AVG(ch1_resistance), 0)::float8 AS ch1,
+                   COALESCE(AVG(ch2_resistance), 0)::float8 AS ch2,
+                   COALESCE(AVG(ch3_resistance), 0)::float8 AS ch3,
+                   COALESCE(AVG(bus_voltage), 0)::float8 AS bus,
+                   COALESCE(AVG(current), 0)::float8 AS curr
             FROM Electrode_Measurements
-            ORDER BY test_timestamp ASC;
+            {where_clause}
+            GROUP BY 1
+            ORDER BY 1 {order}
+            LIMIT %(limit)s
         """
 
-        cursor.execute(select_query)
-        rows = cursor.fetchall()
+    # Hele JSON-svaret bygges af PostgreSQL med json_agg, så Python hverken
+    # ser de enkelte rækker eller skal serialisere dem. Ingen rækker giver
+    # tomme lister (og channels = []), ligesom EMPTY_SENSOR_DATA.
+    select_query = f"""
+        SELECT json_build_object(
+                   'timestamps', COALESCE(json_agg(ts ORDER BY ts), '[]'),
+                   'channels', CASE WHEN count(*) > 0
+                                    THEN '{SENSOR_CHANNELS_JSON}'::json
+                                    ELSE '[]'::json END,
+                   'ch0', COALESCE(json_agg(ch0 ORDER BY ts), '[]'),
+                   'ch1', COALESCE(json_agg(ch1 ORDER BY ts), '[]'),
+                   'ch2', COALESCE(json_agg(ch2 ORDER BY ts), '[]'),
+                   'ch3', COALESCE(json_agg(ch3 ORDER BY ts), '[]'),
+                   'bus_voltage', COALESCE(json_agg(bus ORDER BY ts), '[]'),
+                   'current', COALESCE(json_agg(curr ORDER BY ts), '[]'),
+                   'sensor_name', %(sensor_name)s::text,
+                   'unit', %(unit)s::text,
+                   'count', count(*)
+               )::text
+        FROM ({rows_query}) AS m
+    """
 
-        for row in rows:
-            dt = row[0]   # test_timestamp
-            r0 = row[1]   # ch0_resistance
-            r1 = row[2]   # ch1_resistance
-            r2 = row[3]   # ch2_resistance
-            r3 = row[4]   # ch3_resistance
-            bv = row[5]   # bus_voltage
-            cur = row[6]  # current
-
-            # Timestamp -> ISO string
-            if isinstance(dt, datetime):
-                timestamps.append(dt.isoformat())
-            else:
-                timestamps.append(str(dt))
-
-            # Modstande: sørg for, at vi aldrig sender None til Plotly
-            ch0_list.append(float(r0) if r0 is not None else 0.0)
-            ch1_list.append(float(r1) if r1 is not None else 0.0)
-            ch2_list.append(float(r2) if r2 is not None else 0.0)
-            ch3_list.append(float(r3) if r3 is not None else 0.0)
-
-            # Bus voltage + current
-            bus_list.append(float(bv) if bv is not None else 0.0)
-            curr_list.append(float(cur) if cur is not None else 0.0)
+    # Nye tests skal med, selvom baggrundstråden ikke har flushet endnu
+    if _PENDING:
+        flush_measurements()
+
+    # Mellem refreshes genbruges det seneste fulde svar i op til
+    # SENSOR_CACHE_TTL (?since=/?bucket=/?limit=-svar caches ikke)
+    with _SENSOR_CACHE_LOCK:
+        if (cacheable and _SENSOR_CACHE["body"] is not None
+                and time.monotonic() < _SENSOR_CACHE["expires"]):
+            return json_response(_SENSOR_CACHE["body"], _SENSOR_CACHE["etag"])
+        generation = _SENSOR_CACHE["generation"]
+
+    params = {
+        "since": since,
+        "bucket": bucket,
+        "points": SENSOR_TARGET_POINTS,
+        "limit": limit,
+        "sensor_name": SENSOR_NAME,
+        "unit": SENSOR_UNIT,
+    }
+
+    try:
+        # Svaret er én række, så en almindelig cursor er nok. prepare=True:
+        # forespørgslen er en af få faste tekster, og planen genbruges på
+        # den poolede forbindelse.
+        with get_db_connection() as connection, connection.cursor() as cursor:
+            cursor.execute(select_query, params, prepare=True)
+            (document,) = cursor.fetchone()
 
     except (Exception, psycopg.Error) as error:
         print("Error while fetching electrode measurement data:", error)
 
-        # Hvis der sker fejl, returnér gyldig JSON med tomme lister,
-        # så frontend/Plotly ikke crasher.
-        return {
-            "timestamps": [],
-            "channels": [],
-            "ch0": [],
-            "ch1": [],
-            "ch2": [],
-            "ch3": [],
-            "bus_voltage": [],
-            "current": [],
-            "sensor_name": SENSOR_NAME,
-            "unit": SENSOR_UNIT,
-            "count": 0,
-        }
+        return json_response(orjson.dumps(EMPTY_SENSOR_DATA))
 
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+    body = document.encode()
+    etag = make_etag(body)
 
-    # Hvis der ingen rækker er, giver channels ingen mening -> tom liste
-    if len(timestamps) == 0:
-        channels = []
-    else:
-        # Vi har altid 4 kanaler i vores setup: 0,1,2,3
-        channels = [0, 1, 2, 3]
+    # Gem kun hvis der ikke er skrevet nye målinger mens vi læste
+    with _SENSOR_CACHE_LOCK:
+        if cacheable and _SENSOR_CACHE["generation"] == generation:
+            _SENSOR_CACHE["body"] = body
+            _SENSOR_CACHE["etag"] = etag
+            _SENSOR_CACHE["expires"] = time.monotonic() + SENSOR_CACHE_TTL
+    return json_response(body, etag)
 
+
+# --------------------------------------------------
+# API: Remote Procedure Call til Raspberry Pi
+# --------------------------------------------------
+def remote_error(message):
+    """Fejl skal stadig give gyldig JSON (så frontend ikke dør)."""
+    now = datetime.now()
     return {
-        "timestamps": timestamps,
-        "channels": channels,
-        "ch0": ch0_list,
-        "ch1": ch1_list,
-        "ch2": ch2_list,
-        "ch3": ch3_list,
-        "bus_voltage": bus_list,
-        "current": curr_list,
-        "sensor_name": SENSOR_NAME,
+        "message": message,
+        "timestamp": now.isoformat(),
+        "channels": [],
+        "voltages": [],
+        "resistances": [],
+        "statuses": [],
+        "electrode_count": 0,
+        "bus_voltage": 0.0,
+        "current": 0.0,
         "unit": SENSOR_UNIT,
-        "count": len(timestamps),
+        "samples": [],
     }
 
 
-# --------------------------------------------------
-# API: Remote Procedure Call til Raspberry Pi
-# --------------------------------------------------
-@app.post("/api/start-remote-test")
-@app.output(RemoteStartOut)
-def start_remote_test():
+def run_remote_test(n=1):
     """
-    RPC-endpoint:
-      - Bliver kaldt fra hjemmesiden (knappen i index.html).
-      - Sender POST-kald til Raspberry Pi's /start-test.
-      - Gemmer resultatet i Electrode_Measurements.
-      - Returnerer Pi'ens data + timestamp til frontend.
+    Selve RPC-kaldet (kører i RPC_EXECUTOR):
+      - Sender POST-kald til Raspberry Pi's /start-test med n målinger.
+      - Lægger alle målinger i kø til Electrode_Measurements.
+      - Returnerer Pi'ens data + timestamp (RemoteStartOut).
     """
-    pi_host = RASPI_CFG.get("host", "127.0.0.1")
-    pi_port = RASPI_CFG.get("port", 5001)
-
-    url = f"http://{pi_host}:{pi_port}/start-test"
+    if not PI_BREAKER.allow():
+        return remote_error("Raspberry Pi svarer ikke – prøv igen om lidt")
 
+    # Breakeren tæller kun selve HTTP-kaldet: svarer Pi'en, er den oppe,
+    # også selvom indholdet senere viser sig at være ugyldigt.
     try:
-        res = requests.post(url, timeout=10)
+        res = PI_SESSION.post(PI_URL, params={"n": n}, timeout=PI_TIMEOUT)
         res.raise_for_status()
+    except Exception as e:
+        PI_BREAKER.record(False)
+        print("Error while calling Raspberry Pi:", e)
+        return remote_error("Kunne ikke kontakte Raspberry Pi")
+
+    PI_BREAKER.record(True)
+
+    try:
         data = res.json()
 
         # Forventet JSON fra test.py:
@@ -263,58 +711,51 @@ def start_remote_test():
         #   "statuses": [...],
         #   "electrode_count": 4,
         #   "bus_voltage": ...,
-        #   "current": ...
+        #   "current": ...,
+        #   "samples": [{"elapsed": ..., "resistances": [...], ...}, ...]
         # }
 
         channels = data.get("channels", [])
         resistances = data.get("resistances", [])
         bus_voltage = data.get("bus_voltage", 0.0)
         current = data.get("current", 0.0)
-        electrode_count = data.get("electrode_count", len(channels))
+        electrode_count = int(data.get("electrode_count", len(channels)))
 
-        # Sikr at vi har mindst 4 værdier. Hvis ikke, padder vi med 0.
-        r0 = float(resistances[0]) if len(resistances) > 0 else 0.0
-        r1 = float(resistances[1]) if len(resistances) > 1 else 0.0
-        r2 = float(resistances[2]) if len(resistances) > 2 else 0.0
-        r3 = float(resistances[3]) if len(resistances) > 3 else 0.0
+        # Ældre Pi-firmware uden samples svarer med én måling på topniveau
+        samples = data.get("samples") or [
+            {"elapsed": 0.0, "resistances": resistances,
+             "bus_voltage": bus_voltage, "current": current}
+        ]
 
-        # Opret timestamp for denne test
+        # Sidste måling får "nu"; de tidligere forskydes med Pi'ens elapsed
         now = datetime.now()
-
-        # Gem i databasen
-        connection = None
-        cursor = None
-        try:
-            connection = get_db_connection()
-            cursor = connection.cursor()
-
-            insert_query = """
-                INSERT INTO Electrode_Measurements
-                    (test_timestamp,
-                     ch0_resistance,
-                     ch1_resistance,
-                     ch2_resistance,
-                     ch3_resistance,
-                     bus_voltage,
-                     current,
-                     electrode_count)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s);
-            """
-
-            cursor.execute(
-                insert_query,
-                (now, r0, r1, r2, r3, float(bus_voltage), float(current), electrode_count),
+        last_elapsed = samples[-1].get("elapsed", 0.0)
+
+        rows = []
+        saved = []
+        for sample in samples:
+            ts = now - timedelta(seconds=last_elapsed - sample.get("elapsed", 0.0))
+            r = sample.get("resistances", [])
+
+            # Rækken bygges én gang i COPY-kolonnernes rækkefølge; hver værdi
+            # castes kun én gang. Mangler der kanaler, padder vi med 0.
+            row = (
+                ts,
+                *(float(r[i]) if i < len(r) else 0.0 for i in range(4)),
+                float(sample.get("bus_voltage", 0.0)),
+                float(sample.get("current", 0.0)),
+                electrode_count,
             )
+            rows.append(row)
+            saved.append({
+                "timestamp": ts.isoformat(),
+                "resistances": r,
+                "bus_voltage": row[5],
+                "current": row[6],
+            })
 
-        except (Exception, psycopg.Error) as db_error:
-            print("Error while inserting electrode measurement:", db_error)
-            # Vi lader stadig RPC-svaret gå tilbage, selvom DB insert fejlede.
-
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+        # Gem i databasen – skrives samlet med COPY af flush_measurements()
+        _PENDING.extend(rows)
 
         # Returnér data videre til frontend
         return {
@@ -325,31 +766,65 @@ def start_remote_test():
             "resistances": resistances,
             "statuses": data.get("statuses", []),
             "electrode_count": electrode_count,
-            "bus_voltage": float(bus_voltage),
-            "current": float(current),
+            # Topniveauet er den sidste måling – genbrug dens allerede castede værdier
+            "bus_voltage": rows[-1][5],
+            "current": rows[-1][6],
             "unit": SENSOR_UNIT,
+            "samples": saved,
         }
 
     except Exception as e:
-        print("Error while calling Raspberry Pi:", e)
-        # Fejl skal stadig give gyldig JSON (så frontend ikke dør).
-        now = datetime.now()
-        return {
-            "message": "Kunne ikke kontakte Raspberry Pi",
-            "timestamp": now.isoformat(),
-            "channels": [],
-            "voltages": [],
-            "resistances": [],
-            "statuses": [],
-            "electrode_count": 0,
-            "bus_voltage": 0.0,
-            "current": 0.0,
-            "unit": SENSOR_UNIT,
-        }
+        print("Invalid response from Raspberry Pi:", e)
+        return remote_error("Ugyldigt svar fra Raspberry Pi")
+
+
+@app.post("/api/start-remote-test")
+@app.input(RemoteStartQuery, location="query")
+@app.output(RemoteJobOut, status_code=202)
+def start_remote_test(query_data):
+    """
+    RPC-endpoint:
+      - Bliver kaldt fra hjemmesiden (knappen i index.html).
+      - ?n=K beder Pi'en om K målinger i samme kald.
+      - Starter run_remote_test i baggrunden og svarer straks med et job_id.
+      - Frontend poller /api/job/<job_id> for resultatet.
+    """
+    job_id = uuid.uuid4().hex
+    now = time.monotonic()
+
+    with _JOBS_LOCK:
+        # Ryd gamle jobs (ældste ligger forrest)
+        while _JOBS:
+            oldest_future, created = next(iter(_JOBS.values()))
+            if now - created < JOB_TTL or not oldest_future.done():
+                break
+            _JOBS.popitem(last=False)
+
+        _JOBS[job_id] = (RPC_EXECUTOR.submit(run_remote_test, query_data["n"]), now)
+
+    return {"job_id": job_id, "status": "pending", "result": None}
+
+
+@app.get("/api/job/<job_id>")
+@app.output(RemoteJobOut)
+def get_job(job_id):
+    """Returnér status for en remote test – 202 mens den kører, 200 når den er færdig."""
+    with _JOBS_LOCK:
+        job = _JOBS.get(job_id)
+
+    if job is None:
+        abort(404, "Ukendt job")
+
+    future, _ = job
+    if not future.done():
+        return {"job_id": job_id, "status": "pending", "result": None}, 202
+
+    return {"job_id": job_id, "status": "done", "result": future.result()}
 
 
 # --------------------------------------------------
 # Start app'en
 # --------------------------------------------------
+# Produktion kører under gunicorn (se activate.sh); app.run kun til lokal test
 if __name__ == "__main__":
-    app.run(debug=True, host="0.0.0.0")
+    app.run(host="0.0.0.0")
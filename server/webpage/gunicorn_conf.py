@@ -0,0 +1,18 @@
+# --------------------------------------------------
+# Gunicorn-konfiguration til webserveren (se activate.sh)
+# --------------------------------------------------
+# Start: gunicorn -c gunicorn_conf.py app:app
+
+bind = "0.0.0.0:5000"
+
+# Én proces: jobs (/api/job/<id>), sensor-cachen og målings-køen ligger i
+# hukommelsen, så et job skal polles i samme proces som det blev startet i.
+# Samtidighed kommer fra tråde – GIL'en slippes under DB- og Pi-I/O.
+workers = 1
+worker_class = "gthread"
+threads = 16
+
+# Pi-kaldet kører i baggrunden, så ingen request bør tage over 30 s
+timeout = 30
+graceful_timeout = 10
+keepalive = 5